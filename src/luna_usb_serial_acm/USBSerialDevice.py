@@ -4,14 +4,50 @@
 from migen import Module, TSTriple, ClockSignal, ResetSignal, Instance, Signal, ClockDomainsRenamer
 # import litex
 from litex.soc.interconnect import stream
+from litex.build.altera.platform import AlteraPlatform
 
-from .build_verilog import build
+from .build_verilog import build, prebuild
+
+
+def _build_params(usb_pads, id_vendor, id_product, manufacturer_string, product_string):
+    """
+    Parameters passed to build() for the given pads and descriptors
+    """
+    # heuristically determine phy type used based
+    use_ulpi_phy = hasattr(usb_pads, "clk")
+
+    # heuristically determine packet size based on interface
+    # USB needs to have 512 and when we use ULPI we assume HS
+    max_packet_size = 512 if use_ulpi_phy else 64
+
+    return dict(
+        ulpi                = use_ulpi_phy,
+        max_packet_size     = max_packet_size,
+        idVendor            = id_vendor,
+        idProduct           = id_product,
+        manufacturer_string = manufacturer_string,
+        product_string      = product_string
+        )
 
 
 class USBSerialDevice(Module):
     """
     Wrapper for compiled amaranth module
     """
+    @staticmethod
+    def prebuild(
+            usb_pads,
+            id_vendor=0x1209,
+            id_product=0x5af1,
+            manufacturer_string="MSE Lab",
+            product_string="ULPI Device"
+            ):
+        """
+        Start building the verilog a later USBSerialDevice with the same arguments will use
+        in a background thread
+        """
+        return prebuild(**_build_params(usb_pads, id_vendor, id_product, manufacturer_string, product_string))
+
     def __init__(
             self,
             platform,
@@ -19,28 +55,25 @@ class USBSerialDevice(Module):
             stream_clockdomain="sys", usb_clockdomain="usb", usb_io_clockdomain="usb_io",
             rx_fifo_depth = 1024,
             tx_fifo_depth = 1024,
+            cdc_fifo_depth = None,
+            cdc_buffered = False,
+            stream_fifo_depth = 8,
+            fpga_altera = None,
             id_vendor=0x1209,
             id_product=0x5af1,
             manufacturer_string="MSE Lab",
             product_string="ULPI Device"
             ):
 
-        # heuristically determine phy type used based
-        use_ulpi_phy = hasattr(usb_pads, "clk")
-
-        # heuristically determine packet size based on interface
-        # USB needs to have 512 and when we use ULPI we assume HS
-        max_packet_size = 512 if use_ulpi_phy else 64
+        # Altera/Intel FPGAs lack async read RAM, so FIFO storage must use a synchronous read port
+        # to map onto block RAM instead of flip-flops
+        if fpga_altera is None:
+            fpga_altera = isinstance(platform, AlteraPlatform)
 
         # build verilog
-        verilog_file, module_name = build (
-            ulpi                = use_ulpi_phy,
-            max_packet_size     = max_packet_size,
-            idVendor            = id_vendor,
-            idProduct           = id_product,
-            manufacturer_string = manufacturer_string,
-            product_string      = product_string
-            )
+        params = _build_params(usb_pads, id_vendor, id_product, manufacturer_string, product_string)
+        use_ulpi_phy = params["ulpi"]
+        verilog_file, module_name = build(**params)
 
         # Attach verilog block to module
         platform.add_source(verilog_file)
@@ -49,94 +82,145 @@ class USBSerialDevice(Module):
         self.sink = self.usb_tx = stream.Endpoint([("data", 8)])
         self.source = self.usb_rx = stream.Endpoint([("data", 8)])
 
-        # Add clock domain crossing FIFOs
-        tx_cdc = stream.ClockDomainCrossing([("data", 8)], stream_clockdomain, usb_clockdomain)
-        rx_cdc = stream.ClockDomainCrossing([("data", 8)], usb_clockdomain, stream_clockdomain)
-        self.submodules += tx_cdc, rx_cdc
+        # Collected here and attached once at the end
+        submodules = []
+        specials = []
+        comb = []
 
         # Add phy side fifos
-        tx_fifo = ClockDomainsRenamer(usb_clockdomain)(stream.SyncFIFO([("data", 8)], depth=tx_fifo_depth))
-        rx_fifo = ClockDomainsRenamer(usb_clockdomain)(stream.SyncFIFO([("data", 8)], depth=rx_fifo_depth))
-        self.submodules += tx_fifo, rx_fifo
-        
-        self.comb += [
-            self.usb_tx.connect(tx_cdc.sink),
-            tx_cdc.source.connect(tx_fifo.sink),
-            rx_fifo.source.connect(rx_cdc.sink),
-            rx_cdc.source.connect(self.usb_rx),
-        ]
+        tx_fifo = ClockDomainsRenamer(usb_clockdomain)(stream.SyncFIFO([("data", 8)], depth=tx_fifo_depth, buffered=fpga_altera))
+        rx_fifo = ClockDomainsRenamer(usb_clockdomain)(stream.SyncFIFO([("data", 8)], depth=rx_fifo_depth, buffered=fpga_altera))
+        submodules += [tx_fifo, rx_fifo]
+
+        if stream_clockdomain == usb_clockdomain:
+            # Streams already run in the usb domain, no crossing required
+            comb += [
+                self.usb_tx.connect(tx_fifo.sink),
+                rx_fifo.source.connect(self.usb_rx),
+            ]
+        else:
+            # Add stream side elastic buffers, so back-pressure from the stream side
+            # does not immediately stall the clock domain crossing
+            if stream_fifo_depth:
+                tx_buffer = ClockDomainsRenamer(stream_clockdomain)(stream.SyncFIFO([("data", 8)], depth=stream_fifo_depth, buffered=fpga_altera))
+                rx_buffer = ClockDomainsRenamer(stream_clockdomain)(stream.SyncFIFO([("data", 8)], depth=stream_fifo_depth, buffered=fpga_altera))
+                submodules += [tx_buffer, rx_buffer]
+
+                comb += [
+                    self.usb_tx.connect(tx_buffer.sink),
+                    rx_buffer.source.connect(self.usb_rx),
+                ]
+
+                tx_stream, rx_stream = tx_buffer.source, rx_buffer.sink
+            else:
+                tx_stream, rx_stream = self.usb_tx, self.usb_rx
+
+            # Add clock domain crossing FIFOs
+            # None keeps the LiteX default depth. Unbuffered FIFOs are first-word-fall-through,
+            # buffered ones register the output for timing at the cost of a cycle of latency.
+            tx_cdc = stream.ClockDomainCrossing([("data", 8)], stream_clockdomain, usb_clockdomain,
+                depth=cdc_fifo_depth, buffered=cdc_buffered)
+            rx_cdc = stream.ClockDomainCrossing([("data", 8)], usb_clockdomain, stream_clockdomain,
+                depth=cdc_fifo_depth, buffered=cdc_buffered)
+            submodules += [tx_cdc, rx_cdc]
+
+            comb += [
+                tx_stream.connect(tx_cdc.sink),
+                tx_cdc.source.connect(tx_fifo.sink),
+                rx_fifo.source.connect(rx_cdc.sink),
+                rx_cdc.source.connect(rx_stream),
+            ]
+
+        clk_usb = ClockSignal(usb_clockdomain)
+        rst_usb = ResetSignal(usb_clockdomain)
 
-        self.params = dict(
+        self.params = [
             # Clock / Reset
-            i_clk_usb   = ClockSignal(usb_clockdomain),
-            i_clk_sync   = ClockSignal(usb_clockdomain),
-            i_rst_sync   = ResetSignal(usb_clockdomain),
+            Instance.Input("clk_usb",      clk_usb),
+            Instance.Input("clk_sync",     clk_usb),
+            Instance.Input("rst_sync",     rst_usb),
 
             # Tx stream (Data out: USB device to computer)
-            o_tx__ready   = tx_fifo.source.ready,
-            i_tx__valid   = tx_fifo.source.valid,
-            i_tx__first   = tx_fifo.source.first,
-            i_tx__last    = tx_fifo.source.last,
-            i_tx__payload = tx_fifo.source.data,
+            Instance.Output("tx__ready",   tx_fifo.source.ready),
+            Instance.Input("tx__valid",    tx_fifo.source.valid),
+            Instance.Input("tx__first",    tx_fifo.source.first),
+            Instance.Input("tx__last",     tx_fifo.source.last),
+            Instance.Input("tx__payload",  tx_fifo.source.data),
             
             # Rx Stream (Data in: From a Computer to USB Device)
-            i_rx__ready   = rx_fifo.sink.ready,
-            o_rx__valid   = rx_fifo.sink.valid,
-            o_rx__first   = rx_fifo.sink.first,
-            o_rx__last    = rx_fifo.sink.last,
-            o_rx__payload = rx_fifo.sink.data,
-        )
+            Instance.Input("rx__ready",    rx_fifo.sink.ready),
+            Instance.Output("rx__valid",   rx_fifo.sink.valid),
+            Instance.Output("rx__first",   rx_fifo.sink.first),
+            Instance.Output("rx__last",    rx_fifo.sink.last),
+            Instance.Output("rx__payload", rx_fifo.sink.data),
+        ]
         
         ##### Phy specific setup
 
         if not use_ulpi_phy:
 
-            # Create tristates
-            dp = TSTriple(1)
-            dn = TSTriple(1)
+            clk_io = ClockSignal(usb_io_clockdomain)
+            rst_io = ResetSignal(usb_io_clockdomain)
 
-            self.specials += [
-                dp.get_tristate(usb_pads.d_p),
-                dn.get_tristate(usb_pads.d_n),
-            ]
+            if hasattr(usb_pads, "d_p_i"):
+                # Pads are already split into i/o/oe, no tristate needed
+                dp_o, dp_oe, dp_i = usb_pads.d_p_o, usb_pads.d_p_oe, usb_pads.d_p_i
+                dn_o, dn_oe, dn_i = usb_pads.d_n_o, usb_pads.d_n_oe, usb_pads.d_n_i
+
+            else:
+                # Create tristates
+                dp = TSTriple(1)
+                dn = TSTriple(1)
+
+                specials += [
+                    dp.get_tristate(usb_pads.d_p),
+                    dn.get_tristate(usb_pads.d_n),
+                ]
+
+                dp_o, dp_oe, dp_i = dp.o, dp.oe, dp.i
+                dn_o, dn_oe, dn_i = dn.o, dn.oe, dn.i
 
             # Connect pads to phy
-            self.params = self.params | dict(
-                i_usb_io_clk = ClockSignal(usb_io_clockdomain),
-                i_usb_io_rst = ResetSignal(usb_io_clockdomain),
+            self.params += [
+                Instance.Input("usb_io_clk",           clk_io),
+                Instance.Input("usb_io_rst",           rst_io),
 
                 # IO
-                o_raw_pads__d_p__o    = dp.o,
-                o_raw_pads__d_p__oe   = dp.oe,
-                i_raw_pads__d_p__i    = dp.i,
-                o_raw_pads__d_n__o    = dn.o,
-                o_raw_pads__d_n__oe   = dn.oe,
-                i_raw_pads__d_n__i    = dn.i,
-                o_raw_pads__pullup__o = usb_pads.pullup,
-            )
+                Instance.Output("raw_pads__d_p__o",    dp_o),
+                Instance.Output("raw_pads__d_p__oe",   dp_oe),
+                Instance.Input("raw_pads__d_p__i",     dp_i),
+                Instance.Output("raw_pads__d_n__o",    dn_o),
+                Instance.Output("raw_pads__d_n__oe",   dn_oe),
+                Instance.Input("raw_pads__d_n__i",     dn_i),
+                Instance.Output("raw_pads__pullup__o", usb_pads.pullup),
+            ]
 
         else:
 
             # Active LOW reset signal
             reset = Signal()
-            self.comb += usb_pads.rst.eq(~reset)
+            comb.append(usb_pads.rst.eq(~reset))
 
             # Create tristate
             ulpi_data = TSTriple(8)
-            self.specials += ulpi_data.get_tristate(usb_pads.data)
+            specials.append(ulpi_data.get_tristate(usb_pads.data))
             
             # Connect pads to phy
-            self.params = self.params | dict(
-                o_ulpi_pads__data__o  = ulpi_data.o,
-                o_ulpi_pads__data__oe = ulpi_data.oe,
-                i_ulpi_pads__data__i  = ulpi_data.i,
-                o_ulpi_pads__clk__o   = usb_pads.clk,
-                o_ulpi_pads__stp__o   = usb_pads.stp,
-                i_ulpi_pads__nxt__i   = usb_pads.nxt,
-                i_ulpi_pads__dir__i   = usb_pads.dir,
-                o_ulpi_pads__rst__o   = reset,
-            )
-
-        self.specials += Instance(module_name,
-            **self.params
-        )
+            self.params += [
+                Instance.Output("ulpi_pads__data__o",  ulpi_data.o),
+                Instance.Output("ulpi_pads__data__oe", ulpi_data.oe),
+                Instance.Input("ulpi_pads__data__i",   ulpi_data.i),
+                Instance.Output("ulpi_pads__clk__o",   usb_pads.clk),
+                Instance.Output("ulpi_pads__stp__o",   usb_pads.stp),
+                Instance.Input("ulpi_pads__nxt__i",    usb_pads.nxt),
+                Instance.Input("ulpi_pads__dir__i",    usb_pads.dir),
+                Instance.Output("ulpi_pads__rst__o",   reset),
+            ]
+
+        specials.append(Instance(module_name,
+            *self.params
+        ))
+
+        self.submodules += submodules
+        self.specials += specials
+        self.comb += comb
@@ -2,17 +2,89 @@
 # License: BSD
 
 import os
+import json
+import hashlib
+import tempfile
+import inspect
+import itertools
+import functools
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from importlib import metadata
 from pathlib import Path
 
-from amaranth import Record, Signal, Module, Elaboratable, ClockDomain, ClockSignal, ResetSignal
 
-from amaranth.hdl.rec import DIR_FANIN, DIR_FANOUT, DIR_NONE
-from amaranth.back import verilog
+# Default location for generated verilog
+_VDIR = Path(__file__).resolve().parent / "verilog"
 
-from luna.full_devices import USBSerialDevice as LunaDeviceACM
-from luna.gateware.architecture.car import PHYResetController
+# Attributes of LunaUSBSerialDevice that are candidates for top level ports
+_PORT_ATTRS = ("bus", "rx", "tx", "clk_sync", "clk_usb", "rst_sync", "usb_holdoff")
 
+# Identifies this generator, so edits to the wrapper invalidate cached verilog
+_GENERATOR_DIGEST = hashlib.blake2b(Path(__file__).read_bytes()).hexdigest()[:16]
 
+
+def _versions():
+    """
+    Versions of the packages the generated verilog depends on
+    """
+    versions = {}
+    for package in ("amaranth", "luna-usb"):
+        try:
+            versions[package] = metadata.version(package)
+        except metadata.PackageNotFoundError:
+            versions[package] = None
+    return versions
+
+
+def _write_atomic(path, text):
+    """
+    Replace path with text atomically, so readers never see a partial file
+    """
+    # Unique temp file per writer, so concurrent builds of the same file don't collide
+    fd, tmp_file = tempfile.mkstemp(dir=path.parent, prefix=path.name, suffix=".tmp")
+    try:
+        with open(fd, "w") as f:
+            f.write(text)
+        # mkstemp creates the file private to its owner, match a regular write instead
+        os.chmod(tmp_file, 0o644)
+        os.replace(tmp_file, path)
+    except BaseException:
+        os.unlink(tmp_file)
+        raise
+
+
+def _same_content(path, text, chunk_size=1 << 16):
+    """
+    Compare the contents of path against text a chunk at a time, without loading the whole file
+    """
+    try:
+        with open(path) as f:
+            for offset in range(0, len(text), chunk_size):
+                if f.read(chunk_size) != text[offset:offset + chunk_size]:
+                    return False
+            return f.read(1) == ""
+    except OSError:
+        return False
+
+
+def _write_verilog(verilog_file, elaboratable, name, ports):
+    """
+    Convert elaboratable to verilog and write it out. Kept in its own frame so the
+    generated text is released as soon as it is on disk
+    """
+    from amaranth.back import verilog
+
+    verilog_text = verilog.convert(elaboratable, name=name, ports=ports, strip_internal_attrs=True)
+
+    # Leave identical files untouched so downstream builds see no timestamp change
+    if _same_content(verilog_file, verilog_text):
+        return
+
+    _write_atomic(verilog_file, verilog_text)
+
+
+@functools.lru_cache(maxsize=None)
 def build(
     idVendor=0x1209,
     idProduct=0x5af1,
@@ -22,12 +94,78 @@ def build(
     ulpi = False,
     output_dir = None
     ):
+    """
+    Build verilog for the given parameters, memoized for the lifetime of the process
+    """
+    params = dict(
+        idVendor=idVendor,
+        idProduct=idProduct,
+        manufacturer_string=manufacturer_string,
+        product_string=product_string,
+        max_packet_size=max_packet_size,
+        ulpi=ulpi,
+        output_dir=output_dir
+        )
+
+    # Pick up a matching build already running in the background, at most once
+    with _prebuild_lock:
+        future = _prebuild_futures.pop(tuple(params.items()), None)
+
+    if future is not None:
+        try:
+            return future.result()
+        except Exception:
+            # Retry in the foreground, so errors surface from this call
+            pass
+
+    return _build_impl(**params)
+
+
+_prebuild_lock = threading.Lock()
+_prebuild_executor = None
+_prebuild_futures = {}
+
+
+def prebuild(**kwargs):
+    """
+    Start building verilog in a background thread, so elaboration overlaps with
+    the rest of SoC construction. A later build() with exactly the same parameters
+    waits for this result instead of elaborating again. Use USBSerialDevice.prebuild()
+    to derive the parameters the same way USBSerialDevice does.
+    """
+    global _prebuild_executor
+
+    bound = inspect.signature(build).bind(**kwargs)
+    bound.apply_defaults()
+    key = tuple(bound.arguments.items())
+
+    with _prebuild_lock:
+        if _prebuild_executor is None:
+            _prebuild_executor = ThreadPoolExecutor(1)
+
+        future = _prebuild_futures.get(key)
+        if future is None:
+            future = _prebuild_futures[key] = _prebuild_executor.submit(_build_impl, **bound.arguments)
+
+    return future
+
+
+@functools.lru_cache(maxsize=None)
+def _device_class():
+    """
+    Define the Elaboratable wrapping the LUNA device, once per process. Built lazily
+    so amaranth and luna are only imported when elaborating
+    """
+    from amaranth import Record, Signal, Module, Elaboratable, ClockDomain, ClockSignal, ResetSignal
+
+    from luna.full_devices import USBSerialDevice as LunaDeviceACM
+    from luna.gateware.architecture.car import PHYResetController
 
     class LunaUSBSerialDevice(Elaboratable):
         """
         Amaranth module that exposes internal interfaces as Signal/Record attributes
         """
-        def __init__(self, bus):
+        def __init__(self, bus, idVendor, idProduct, manufacturer_string, product_string, max_packet_size):
 
             self.bus = bus
 
@@ -95,6 +233,48 @@ def build(
             ]
             return m
 
+    return LunaUSBSerialDevice
+
+
+def _build_impl(
+    idVendor,
+    idProduct,
+    manufacturer_string,
+    product_string,
+    max_packet_size,
+    ulpi,
+    output_dir
+    ):
+
+    if output_dir is None:
+        output_dir = _VDIR
+
+    # Generated verilog is cached on disk, keyed on the parameters that shape it.
+    # The digest is part of the module name, so several configurations can share a design
+    key = (idVendor, idProduct, manufacturer_string, product_string, ulpi, max_packet_size)
+    digest = hashlib.blake2b(repr(key).encode()).hexdigest()[:16]
+
+    name = f"LunaUSBSerialDevice_{'ULPI' if ulpi else 'RAW'}_{digest}"
+
+    verilog_file = Path(output_dir) / f"{name}.v"
+    manifest_file = verilog_file.with_suffix(".json")
+    manifest = dict(parameters=list(key), versions=_versions(), generator=_GENERATOR_DIGEST)
+
+    # A missing or unreadable manifest is a cache miss
+    try:
+        cached = json.loads(manifest_file.read_text())
+    except (OSError, ValueError):
+        cached = None
+
+    if cached == manifest and verilog_file.exists():
+        return verilog_file, name
+
+    # amaranth is slow to import, only pull it in when elaborating
+    from amaranth import Record, Signal
+
+    from amaranth.hdl.rec import DIR_FANIN, DIR_FANOUT, DIR_NONE
+
+    LunaUSBSerialDevice = _device_class()
 
     raw_pads = Record(
     [
@@ -113,27 +293,27 @@ def build(
         ('rst', [('o', 1, DIR_FANOUT)])
     ])
 
-    elaboratable = LunaUSBSerialDevice(bus = ulpi_pads if ulpi else raw_pads)
-    name = 'LunaUSBSerialDevice_ULPI' if ulpi else 'LunaUSBSerialDevice_RAW'
-
-    ports = []
+    elaboratable = LunaUSBSerialDevice(
+        bus = ulpi_pads if ulpi else raw_pads,
+        idVendor=idVendor,
+        idProduct=idProduct,
+        manufacturer_string=manufacturer_string,
+        product_string=product_string,
+        max_packet_size=max_packet_size
+        )
 
     # Patch through all Records/Ports
-    for port_name, port in vars(elaboratable).items():
-        if not port_name.startswith("_") and isinstance(port, (Signal, Record)):
-            ports += port._lhs_signals()
-
-    verilog_text = verilog.convert(elaboratable, name=name, ports=ports, strip_internal_attrs=True)
-
-    if output_dir is None:
-        output_dir = Path(__file__).parent / "verilog"
+    ports = list(itertools.chain.from_iterable(
+        port._lhs_signals()
+        for port in (getattr(elaboratable, port_name) for port_name in _PORT_ATTRS)
+        if isinstance(port, (Signal, Record))
+    ))
 
     os.makedirs(output_dir, exist_ok=True)
 
-    verilog_file = output_dir / f"{name}.v"
+    _write_verilog(verilog_file, elaboratable, name, ports)
 
-    with open(verilog_file, "w") as f:
-        f.write(verilog_text)
+    _write_atomic(manifest_file, json.dumps(manifest))
 
     return verilog_file, name
 